@@ -18,255 +18,741 @@
 #     - Simplifies constraints by discarding any accumulated x!= once an x=
 #     equality is set for the same feature.
     
-#     - Low memory footprint with LazyTreeFileScanner by reading the file on demand 
-#     and not loading the entire tree into memory, keeping the memory usage below 
-#     the input file size constraint.
+#     - Trees are parsed once into memory, where parsed nodes take about 20-25x
+#     the file size. Above IN_MEMORY_TREE_MAX_BYTES the LazyTreeFileScanner
+#     reads the file on demand instead of loading the entire tree, memory is
+#     then bounded by its offset index and node cache.
 # ------------------------------------------------------------------------------
 
+import os
+import queue
 import re
-from typing import List, Tuple, Dict, Any, Optional
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple, Dict, Any, Optional, Sequence, Set, TextIO, Callable
 import sys
 
 # ------------------------------------------------------------------------------
 # Parsing a line of the tree with regex
 
+# Node lines may be indented with Unicode spaces (e.g. U+2002), the node line
+# regex keeps Unicode \s. The payload regexes only need ASCII digits/spaces.
 NODE_LINE_REGEX = re.compile(r"^\s*(\d+)\s*:\s*(.+?)\s*$")
-LEAF_REGEX = re.compile(r"^\s*leaf\s*=\s*([+-]?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)\s*$")
-CONDITION_REGEX = re.compile(r"^\[\s*(.*?)\s*\]\s*yes\s*=\s*(\d+)\s*,\s*no\s*=\s*(\d+)\s*$")
-OR_SPLITTER_REGEX = re.compile(r"\s*\|\|or\|\|\s*")
+LEAF_REGEX = re.compile(r"^\s*leaf\s*=\s*([+-]?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)\s*$", re.ASCII)
+CONDITION_REGEX = re.compile(r"^\[\s*(.*?)\s*\]\s*yes\s*=\s*(\d+)\s*,\s*no\s*=\s*(\d+)\s*$", re.ASCII)
 
-def parse_condition_item(condition_text: str) -> Dict[str, Any]:
+# Bound methods, saves the attribute lookup on every parsed line
+NODE_LINE_MATCH = NODE_LINE_REGEX.match
+LEAF_MATCH = LEAF_REGEX.match
+CONDITION_MATCH = CONDITION_REGEX.match
+
+ConditionType = Tuple[str, str, str]  # (feature, op, value)
+# (feature_id, is_equality, value_id, value_bit, "feature op value")
+EncodedCondition = Tuple[int, bool, int, int, str]
+
+NEQ_MASK_BITS = 64  # value ids of a feature kept in its != bitmask, the others in a set
+
+class FeatureCodec:
+    """
+    Integer ids for feature names and, per feature, for their values, so the
+    DFS state is made of plain lists indexed by feature id and compares ints.
+    The first NEQ_MASK_BITS values of a feature also get the single bit
+    1 << value_id, so small sets of forbidden values are int bitmasks; later
+    values get no bit (0) and go to a set, which keeps every bit a machine word.
+    Ids are never mapped back: each encoded condition keeps its formatted text.
+    """
+    __slots__ = ("feature_ids", "feature_names", "value_ids")
+
+    def __init__(self) -> None:
+        self.feature_ids: Dict[str, int] = {}
+        self.feature_names: List[str] = []
+        self.value_ids: List[Dict[str, int]] = []  # per feature id: value -> value id
+
+    def encode_condition(self, cond: ConditionType) -> EncodedCondition:
+        feature_name, op, value_text = cond
+        feature_id = self.feature_ids.get(feature_name)
+        if feature_id is None:
+            feature_id = len(self.feature_names)
+            self.feature_ids[feature_name] = feature_id
+            self.feature_names.append(feature_name)
+            self.value_ids.append({})
+        value_ids = self.value_ids[feature_id]
+        value_id = value_ids.setdefault(value_text, len(value_ids))
+        value_bit = 1 << value_id if value_id < NEQ_MASK_BITS else 0
+        return feature_id, op == "=", value_id, value_bit, f"{feature_name}{op}{value_text}"
+
+def parse_condition_item(condition_text: str) -> ConditionType:
     """
     Parse a simple condition of the form: <feature> (=|!=) <value>.
     """
-    condition_text = condition_text.strip()
-    if "!=" in condition_text:
-        feature_name, value_text = condition_text.split("!=", 1)
-        return {"feature": feature_name.strip(), "op": "!=", "value": value_text.strip()}
-    if "=" in condition_text:
-        feature_name, value_text = condition_text.split("=", 1)
-        return {"feature": feature_name.strip(), "op": "=", "value": value_text.strip()}
-    raise ValueError(f"Invalid condition (expected '=' or '!='): {condition_text!r}")
+    feature_name, separator, value_text = condition_text.partition("!=")
+    if separator:
+        return feature_name.strip(), "!=", value_text.strip()
+    feature_name, separator, value_text = condition_text.partition("=")
+    if separator:
+        return feature_name.strip(), "=", value_text.strip()
+    raise ValueError(f"Invalid condition (expected '=' or '!='): {condition_text.strip()!r}")
+
+# DFS stack frame tags (see flatten_tree_file)
+VISIT_FRAME = 0
+UNDO_FRAME = 1
+
+def make_condition_node(or_conditions: List[ConditionType], yes_id: int, no_id: int,
+                        codec: FeatureCodec) -> Dict[str, Any]:
+    """
+    Build a conditional node object. What the DFS does on each visit is
+    precomputed once here, with conditions encoded by codec:
+      - "negated": the negation of every disjunct (De Morgan) for the NO branch,
+      - "child_frames": the visit frames of all children, pushed in one call
+        on top of the shared parent state: the NO branch with "negated", then
+        one YES branch per OR disjunct.
+    """
+    encode_condition = codec.encode_condition
+    negated = tuple(encode_condition((feature_name, "=" if op == "!=" else "!=", value_text))
+                    for feature_name, op, value_text in or_conditions)
+    child_frames = [(VISIT_FRAME, no_id, negated)]
+    child_frames.extend((VISIT_FRAME, yes_id, (encode_condition(cond),)) for cond in or_conditions)
+    return {
+        "type": "cond",
+        "conds": tuple(or_conditions),
+        "negated": negated,
+        "child_frames": tuple(child_frames),
+        "yes": yes_id,
+        "no": no_id,
+    }
 
-def parse_tree_line(raw_line: str) -> Optional[Dict[str, Any]]:
+def parse_tree_line_fast(node_line: str, codec: FeatureCodec) -> Tuple[int, Dict[str, Any]]:
+    """
+    Split based parser for the usual layout of a stripped node line:
+      id:leaf=value  or  id:[cond ||or|| cond] yes=Y,no=N
+    Only str methods are used (no regex). Digits must be ASCII, as in the
+    re.ASCII regexes. Raise ValueError on anything else, so the caller can fall
+    back to the regex parser.
+    """
+    id_text, separator, node_payload = node_line.partition(":")
+    id_text = id_text.strip()
+    if not (separator and id_text.isascii() and id_text.isdigit()):
+        raise ValueError(f"Invalid node id: {node_line!r}")
+    node_id = int(id_text)
+    node_payload = node_payload.strip()
+
+    # Leaf node
+    if node_payload.startswith("leaf"):
+        key_text, separator, value_text = node_payload.partition("=")
+        value_text = value_text.strip()
+        digits_text = value_text.lstrip("+-")
+        # float() also takes "1.e5", LEAF_REGEX wants a digit after the point
+        point_index = digits_text.find(".")
+        if (not separator or key_text.strip() != "leaf"
+                or not digits_text.isascii() or "_" in digits_text
+                or not (digits_text[:1].isdigit() and digits_text[-1:].isdigit())
+                or (point_index >= 0 and not digits_text[point_index + 1:point_index + 2].isdigit())):
+            raise ValueError(f"Invalid leaf: {node_line!r}")
+        return node_id, {"type": "leaf", "value": float(value_text)}
+
+    # Conditional node
+    close_index = node_payload.rfind("]")
+    if not node_payload.startswith("[") or close_index < 0:
+        raise ValueError(f"Invalid condition node: {node_line!r}")
+    yes_text, separator, no_text = node_payload[close_index + 1:].partition(",")
+    yes_key, yes_separator, yes_id_text = yes_text.partition("=")
+    no_key, no_separator, no_id_text = no_text.partition("=")
+    if not (separator and yes_separator and no_separator
+            and yes_key.strip() == "yes" and no_key.strip() == "no"):
+        raise ValueError(f"Invalid yes/no targets: {node_line!r}")
+    yes_id_text = yes_id_text.strip()
+    no_id_text = no_id_text.strip()
+    if not (yes_id_text.isascii() and yes_id_text.isdigit()
+            and no_id_text.isascii() and no_id_text.isdigit()):
+        raise ValueError(f"Invalid yes/no targets: {node_line!r}")
+
+    or_conditions: List[ConditionType] = []
+    for part in node_payload[1:close_index].split("||or||"):
+        part = part.strip()
+        if part:
+            or_conditions.append(parse_condition_item(part))
+    return node_id, make_condition_node(or_conditions, int(yes_id_text), int(no_id_text), codec)
+
+def parse_tree_line(raw_line: str,
+                    codec: Optional[FeatureCodec] = None) -> Optional[Tuple[int, Dict[str, Any]]]:
     """
     Parse one text line describing a tree node and return:
       (node_id, node_object)
     where node_object is either:
       - {"type": "leaf", "value": <float>}
-      - {"type": "cond", "conds": [list of OR conditions], "yes": <int>, "no": <int>}
+      - {"type": "cond", "conds": (OR conditions as (feature, op, value)),
+         "negated": ..., "child_frames": ..., "yes": <int>, "no": <int>}
+        (see make_condition_node)
     If the line does not match the expected pattern, return None.
+    The split based fast path handles the usual layout, regexes are the fallback.
+    Nodes of one tree must share the same codec.
     """
     raw_line = raw_line.strip()
     if not raw_line:
         return None
+    if codec is None:
+        codec = FeatureCodec()
+
+    try:
+        return parse_tree_line_fast(raw_line, codec)
+    except ValueError:
+        pass
 
-    node_line = NODE_LINE_REGEX.match(raw_line)
+    node_line = NODE_LINE_MATCH(raw_line)
     if not node_line:
         return None
 
+    node_id = int(node_line.group(1))
     node_payload = node_line.group(2).strip()
 
     # Leaf node
-    leaf_match = LEAF_REGEX.match(node_payload)
+    leaf_match = LEAF_MATCH(node_payload)
     if leaf_match:
-        return {"type": "leaf", "value": float(leaf_match.group(1))}
+        return node_id, {"type": "leaf", "value": float(leaf_match.group(1))}
 
     # Conditional node
-    cond_match = CONDITION_REGEX.match(node_payload)
+    cond_match = CONDITION_MATCH(node_payload)
     if cond_match:
         conds_str, yes_id_str, no_id_str = cond_match.groups()
-        or_conditions: List[Dict[str, Any]] = []
+        or_conditions: List[ConditionType] = []
         if conds_str:
-            for part in OR_SPLITTER_REGEX.split(conds_str):
+            for part in conds_str.split("||or||"):
                 part = part.strip()
                 if part:
                     or_conditions.append(parse_condition_item(part))
-        return  {
-            "type": "cond",
-            "conds": or_conditions,  
-            "yes": int(yes_id_str),
-            "no": int(no_id_str),
-        }
+        return node_id, make_condition_node(or_conditions, int(yes_id_str), int(no_id_str), codec)
 
     return None
 
+class TreeNodes(dict):
+    """
+    {node_id: node_object} parsed from file_path. Looking up a missing id
+    raises the same KeyError as LazyTreeFileScanner.get_node_by_id.
+    """
+    __slots__ = ("file_path",)
+
+    def __init__(self, file_path: str) -> None:
+        super().__init__()
+        self.file_path = file_path
+
+    def __missing__(self, node_id: int) -> Dict[str, Any]:
+        raise KeyError(f"Node id {node_id} not found in {self.file_path}")
+
+def parse_tree_file(file_path: str, encoding: str = "utf-8",
+                    codec: Optional[FeatureCodec] = None) -> TreeNodes:
+    """
+    Parse the whole tree file in a single pass and return {node_id: node_object}.
+    Lines that are not valid nodes are ignored, the first line wins for a repeated id.
+    """
+    if codec is None:
+        codec = FeatureCodec()
+    nodes = TreeNodes(file_path)
+    with open(file_path, "r", encoding=encoding) as f:
+        for line in f:
+            parsed = parse_tree_line(line, codec)
+            if parsed is not None:
+                node_id, node_obj = parsed
+                nodes.setdefault(node_id, node_obj)
+    return nodes
+
 # ------------------------------------------------------------------------------
-# Memory O(1) node reader, lazy scan by id
+# Lazy node reader, one indexing pass then direct seeks by id
+
+NODE_ID_PREFIX_REGEX = re.compile(r"^\s*(\d+)\s*:")
+
+LAZY_NODE_CACHE_MAX_NODES = 4096  # parsed nodes are many times larger than their line
 
 class LazyTreeFileScanner:
     """
-    Scans a text tree file and finds a node by its id O(1) memory, linear read.
+    Scans a text tree file once to index node ids to byte offsets, then reads
+    a node by seeking directly to its line. O(V) integers in memory.
+    The last cache_size parsed nodes are kept (LRU), a node reached again
+    through another OR disjunct is usually returned without re-parsing
+    (callers must not mutate it).
+    The file stays open for all lookups, use it as a context manager (or call
+    close()) to release the handle.
     """
-    def __init__(self, file_path: str, encoding: str = "utf-8") -> None:
+    def __init__(self, file_path: str, encoding: str = "utf-8", codec: Optional[FeatureCodec] = None,
+                 cache_size: int = LAZY_NODE_CACHE_MAX_NODES) -> None:
         self.file_path = file_path
         self.encoding = encoding
+        self.codec = codec if codec is not None else FeatureCodec()
+        self.cache_size = cache_size
+        self._offsets: Dict[int, int] = {}
+        self._node_cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._fh = open(file_path, "rb")
+
+        match_node_id = NODE_ID_PREFIX_REGEX.match
+        position = self._fh.tell()
+        for line in iter(self._fh.readline, b""):
+            node_id_match = match_node_id(line.decode(encoding))
+            if node_id_match:
+                self._offsets.setdefault(int(node_id_match.group(1)), position)
+            position += len(line)
 
     def get_node_by_id(self, node_id: int) -> Dict[str, Any]:
-        prefix = f"{node_id}:"
-        with open(self.file_path, "r", encoding=self.encoding) as f:
-            for line in f:
-                if not line.strip():
-                    continue
-                if line.lstrip().startswith(prefix):
-                    parsed = parse_tree_line(line)
-                    if parsed is None:
-                        break
-                    node_obj = parsed
-                    return node_obj
-        raise KeyError(f"Node id {node_id} not found in {self.file_path}")
+        node_cache = self._node_cache
+        node_obj = node_cache.get(node_id)
+        if node_obj is not None:
+            node_cache.move_to_end(node_id)
+            return node_obj
+
+        offset = self._offsets.get(node_id)
+        if offset is None:
+            raise KeyError(f"Node id {node_id} not found in {self.file_path}")
+        self._fh.seek(offset)
+        line = self._fh.readline().decode(self.encoding)
+        parsed = parse_tree_line(line, self.codec)
+        if parsed is None:
+            raise KeyError(f"Node id {node_id} not found in {self.file_path}")
+        node_obj = parsed[1]
+        node_cache[node_id] = node_obj
+        if len(node_cache) > self.cache_size:
+            node_cache.popitem(last=False)
+        return node_obj
+
+    def close(self) -> None:
+        self._fh.close()
+
+    def __enter__(self) -> "LazyTreeFileScanner":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
 
 # ------------------------------------------------------------------------------
 # Compact state representation for pruning contradictions
-# feature -> {"eq": value_or_None, "neq": set()}
-
-StateType = Tuple[Dict[str, Dict[str, Any]], List[str]]  # (feature_state_map, feature_order)
-
-def add_condition_to_state(current_state: StateType,
-                           cond: Dict[str, Any]) -> Optional[StateType]:
-    """
-    Add one condition (= or !=) into the current state.
-    - If a contradiction is found -> return None (branch is pruned).
-    - Otherwise, return a NEW state (shallow copy).
-   
-    Example of current_state ({'A': {'eq': '1', 'neq': set()}}, ['A']) :
-    (
-        {
-            "browser": {"eq": "7", "neq": {"8", "9"}},
-            "os": {"eq": None, "neq": {"linux"}}
-        },
-        ["browser", "os"]  
-    )
-    Example of cond= {'feature': 'A', 'op': '=', 'value': '1'} :
-    """
-    feature_name = cond["feature"]
-    operator_str = cond["op"]
-    value_text = cond["value"]
-
-    feature_state_map, feature_order = current_state
-
-    new_feature_state_map = feature_state_map.copy()
-    if feature_name in new_feature_state_map:
-        entry = new_feature_state_map[feature_name].copy()
-        current_eq_value = entry["eq"]
-        current_neq_values = set(entry["neq"])
-    else:
-        entry = {"eq": None, "neq": set()}
-        current_eq_value = None
-        current_neq_values = set()
-
-    if operator_str == "=":
-        if current_eq_value is not None and current_eq_value != value_text:
-            return None
-        if value_text in current_neq_values:
-            return None
-        entry["eq"] = value_text
-        entry["neq"] = set()  
-    else:  
-        if current_eq_value is not None and current_eq_value == value_text:
-            return None
-        current_neq_values.add(value_text)
-        entry["eq"] = current_eq_value
-        entry["neq"] = current_neq_values
+# One mutable state shared by the whole DFS, every change is recorded in an
+# undo log so that leaving a branch restores the parent state.
+# Lists indexed by feature id (see FeatureCodec):
+#   eq_values[f] = value id or -1, neq_values[f] = OR of the forbidden value bits,
+#   neq_overflow[f] = set of the forbidden value ids without a bit, or None,
+#   slots[f] = index of the feature in strategy_parts or -1 if unconstrained
 
-    new_feature_state_map[feature_name] = entry
+UNDO_DELETE = 0          # (UNDO_DELETE, feature_id): the feature was new, pop its strategy part
+UNDO_CLEAR_EQ = 1        # (UNDO_CLEAR_EQ, feature_id, previous_neq, previous_part, previous_overflow): eq was unset
+UNDO_DISCARD_NEQ = 2     # (UNDO_DISCARD_NEQ, feature_id, value_bit, previous_part): bit was added to neq
+UNDO_DISCARD_NEQ_ID = 3  # (UNDO_DISCARD_NEQ_ID, feature_id, value_id, previous_part): id was added to neq_overflow
 
-    if feature_name not in feature_state_map:
-        new_feature_order = feature_order + [feature_name]
-    else:
-        new_feature_order = feature_order
+UndoLog = List[Tuple[Any, ...]]
 
-    return new_feature_state_map, new_feature_order
+class ConstraintState:
+    """
+    Current conjunction of constraints, as lists indexed by feature id, and
+    strategy_parts, the formatted constraints of each feature ("f=v" or
+    "f!=a & f!=b") in the order features were first constrained, kept up to
+    date by every change.
+    """
+    __slots__ = ("eq_values", "neq_values", "neq_overflow", "slots", "strategy_parts")
+
+    def __init__(self, feature_count: int = 0) -> None:
+        self.eq_values: List[int] = []
+        self.neq_values: List[int] = []
+        self.neq_overflow: List[Optional[Set[int]]] = []
+        self.slots: List[int] = []
+        self.strategy_parts: List[str] = []
+        self.reserve(feature_count)
+
+    def reserve(self, feature_count: int) -> None:
+        """
+        Grow the per-feature lists to hold feature_count features.
+        """
+        missing = feature_count - len(self.slots)
+        if missing > 0:
+            self.eq_values.extend([-1] * missing)
+            self.neq_values.extend([0] * missing)
+            self.neq_overflow.extend([None] * missing)
+            self.slots.extend([-1] * missing)
+
+    def copy(self) -> "ConstraintState":
+        """
+        Independent snapshot of the state (e.g. to hand a subtree to a worker).
+        """
+        snapshot = ConstraintState()
+        snapshot.eq_values = self.eq_values.copy()
+        snapshot.neq_values = self.neq_values.copy()
+        snapshot.neq_overflow = [None if value_ids is None else value_ids.copy()
+                                 for value_ids in self.neq_overflow]
+        snapshot.slots = self.slots.copy()
+        snapshot.strategy_parts = self.strategy_parts.copy()
+        return snapshot
+
+def add_condition_to_state(state: ConstraintState, cond: EncodedCondition,
+                           undo_log: UndoLog) -> bool:
+    """
+    Add one condition (= or !=) into the state, IN PLACE.
+    - If a contradiction is found -> return False, the state is left untouched.
+    - Otherwise, append the undo record of the change to undo_log, return True.
 
-def add_all_conditions_to_state(current_state: StateType,
-                                 conds: List[Dict[str, Any]]) -> Optional[StateType]:
+    Once eq is set, neq values are no longer tracked: they can neither prune
+    a branch nor appear in the output.
+    Example of cond= (0, True, 1, 0b10, 'A=1')
+    """
+    feature_id, is_equality, value_id, value_bit, part = cond
+    strategy_parts = state.strategy_parts
+    slot = state.slots[feature_id]
+
+    if slot < 0:
+        state.slots[feature_id] = len(strategy_parts)
+        strategy_parts.append(part)
+        if is_equality:
+            state.eq_values[feature_id] = value_id
+        elif value_bit:
+            state.neq_values[feature_id] = value_bit
+        else:
+            state.neq_overflow[feature_id] = {value_id}
+        undo_log.append((UNDO_DELETE, feature_id))
+        return True
+
+    current_eq_value = state.eq_values[feature_id]
+    if is_equality:
+        if current_eq_value >= 0:
+            return current_eq_value == value_id
+        current_neq_values = state.neq_values[feature_id]
+        current_neq_overflow = state.neq_overflow[feature_id]
+        if value_bit:
+            if current_neq_values & value_bit:
+                return False
+        elif current_neq_overflow and value_id in current_neq_overflow:
+            return False
+        state.eq_values[feature_id] = value_id
+        state.neq_values[feature_id] = 0
+        state.neq_overflow[feature_id] = None
+        undo_log.append((UNDO_CLEAR_EQ, feature_id, current_neq_values, strategy_parts[slot],
+                         current_neq_overflow))
+        strategy_parts[slot] = part
+        return True
+
+    if current_eq_value >= 0:
+        return current_eq_value != value_id
+    if value_bit:
+        current_neq_values = state.neq_values[feature_id]
+        if current_neq_values & value_bit:
+            return True
+        state.neq_values[feature_id] = current_neq_values | value_bit
+        previous_part = strategy_parts[slot]
+        undo_log.append((UNDO_DISCARD_NEQ, feature_id, value_bit, previous_part))
+    else:
+        current_neq_overflow = state.neq_overflow[feature_id]
+        if current_neq_overflow is None:
+            current_neq_overflow = state.neq_overflow[feature_id] = set()
+        elif value_id in current_neq_overflow:
+            return True
+        current_neq_overflow.add(value_id)
+        previous_part = strategy_parts[slot]
+        undo_log.append((UNDO_DISCARD_NEQ_ID, feature_id, value_id, previous_part))
+    strategy_parts[slot] = f"{previous_part} & {part}"
+    return True
+
+def add_all_conditions_to_state(state: ConstraintState,
+                                conds: Sequence[EncodedCondition]) -> Optional[UndoLog]:
     """
-    Add a list conditions to a state, returns None if any contradiction occurs.
+    Add a list of conditions to the state, IN PLACE, and return their undo log.
+    If any contradiction occurs, the state is restored and None is returned.
     """
-    updated_state: Optional[StateType] = current_state
+    undo_log: UndoLog = []
     for cond in conds:
-        updated_state = add_condition_to_state(updated_state, cond)
-        if updated_state is None:
+        if not add_condition_to_state(state, cond, undo_log):
+            undo_state_changes(state, undo_log)
             return None
-    return updated_state
+    return undo_log
 
-def negate_condition(cond: Dict[str, Any]) -> Dict[str, Any]:
+def undo_state_changes(state: ConstraintState, undo_log: UndoLog) -> None:
     """
-    Negate a simple condition (= <-> !=) for the NO branch.
+    Revert the changes recorded in undo_log, newest first.
     """
-    return {
-        "feature": cond["feature"],
-        "op": "=" if cond["op"] == "!=" else "!=",
-        "value": cond["value"],
-    }
+    strategy_parts = state.strategy_parts
+    for record in reversed(undo_log):
+        action, feature_id = record[0], record[1]
+        if action == UNDO_DELETE:
+            state.slots[feature_id] = -1
+            state.eq_values[feature_id] = -1
+            state.neq_values[feature_id] = 0
+            state.neq_overflow[feature_id] = None
+            strategy_parts.pop()
+        elif action == UNDO_CLEAR_EQ:
+            state.eq_values[feature_id] = -1
+            state.neq_values[feature_id] = record[2]
+            state.neq_overflow[feature_id] = record[4]
+            strategy_parts[state.slots[feature_id]] = record[3]
+        elif action == UNDO_DISCARD_NEQ:
+            state.neq_values[feature_id] ^= record[2]
+            strategy_parts[state.slots[feature_id]] = record[3]
+        else:
+            state.neq_overflow[feature_id].discard(record[2])
+            strategy_parts[state.slots[feature_id]] = record[3]
+
+# ------------------------------------------------------------------------------
+# Depth first expansion
 
-def format_state_as_strategy(state: StateType) -> str:
+def expand_tree(get_node: Callable[[int], Dict[str, Any]], codec: FeatureCodec,
+                state: ConstraintState, start_node_id: int, emit_line: Callable[[str], None],
+                split_depth: Optional[int] = None,
+                on_split: Optional[Callable[[int, ConstraintState], None]] = None) -> None:
     """
-    Format the current state into a readable conjunction: feat=val & feat!=val2 & ...
+    Iterative DFS from start_node_id on top of state, calling emit_line with
+    each strategy line in output order. The state is restored on return.
+
+    If split_depth is given, conditional nodes reached at that depth are not
+    expanded: on_split receives the node id and a copy of the state instead.
     """
-    feature_state_map, feature_order = state
-    parts: List[str] = []
-    for feature_name in feature_order:
-        entry = feature_state_map[feature_name]
-        if entry["eq"] is not None:
-            parts.append(f"{feature_name}={entry['eq']}")
+    # The state is mutated in place: a VISIT frame applies the conditions of
+    # the branch, the UNDO frame pushed under its children reverts them.
+    dfs_stack: List[Tuple[Any, ...]] = [(VISIT_FRAME, start_node_id, ())]
+    depth = 0
+    # UNDO frames only carry their depth, the index of the branch undo log:
+    # one frame per depth is built once and pushed again for every node.
+    undo_logs: List[UndoLog] = []
+    undo_frames: List[Tuple[int, int]] = []
+
+    while dfs_stack:
+        frame = dfs_stack.pop()
+        if frame[0] == UNDO_FRAME:
+            depth -= 1
+            undo_state_changes(state, undo_logs[depth])
+            continue
+
+        _, current_node_id, branch_conds = frame
+        if len(branch_conds) == 1:
+            # Every YES branch and the NO branch of single condition nodes:
+            # a failed add leaves the state untouched, nothing to rewind
+            undo_log = []
+            if not add_condition_to_state(state, branch_conds[0], undo_log):
+                continue
         else:
-            for forbidden_value in entry["neq"]:
-                parts.append(f"{feature_name}!={forbidden_value}")
-    return " & ".join(parts)
+            undo_log = add_all_conditions_to_state(state, branch_conds)
+            if undo_log is None:
+                continue
+
+        node_obj = get_node(current_node_id)
+
+        if node_obj["type"] == "leaf":
+            emit_line(f"{' & '.join(state.strategy_parts)} : {node_obj['value']}".strip())
+            undo_state_changes(state, undo_log)
+            continue
+
+        # The lazy scanner registers features as nodes are read
+        if len(state.slots) < len(codec.feature_names):
+            state.reserve(len(codec.feature_names))
+
+        if depth == split_depth and on_split is not None:
+            on_split(current_node_id, state.copy())
+            undo_state_changes(state, undo_log)
+            continue
+
+        if depth < len(undo_logs):
+            undo_logs[depth] = undo_log
+        else:
+            undo_logs.append(undo_log)
+            undo_frames.append((UNDO_FRAME, depth))
+        dfs_stack.append(undo_frames[depth])
+        depth += 1
+
+        # NO branch with all negated conditions, then one YES branch per
+        # cond; a branch is skipped on visit if it is a contradiction
+        dfs_stack.extend(node_obj["child_frames"])
 
 # ------------------------------------------------------------------------------
-# Flatten tree into strategies with contradiction pruning
+# Output batching
+
+OUTPUT_BUFFER_BYTES = 1 << 20
+OUTPUT_BATCH_LINES = 4096
+OUTPUT_QUEUE_MAX_BATCHES = 8  # bounds the lines waiting for the writer thread
 
-def flatten_tree_file(input_path: str, output_path: str, root_node_id: int = 0) -> None:
+def make_line_batcher(write_batch: Callable[[List[str]], None]) -> Tuple[Callable[[str], None], Callable[[], None]]:
     """
-    Read a binary tree with OR between conditions using '=' and '!=',
-    and generate all AND only strategies, writing them to output_path.
+    Return (emit_line, flush): emit_line collects lines and hands each full
+    batch of OUTPUT_BATCH_LINES to write_batch, flush hands over the rest.
+    A batch list is never reused once handed over.
+    """
+    output_batch: List[str] = []
 
-    - YES branch: one branch for each individual OR condition.
-    - NO branch: all OR conditions are negated and combined.
-    - Any contradiction like browser=7 then browser=8 > branch is skipped.
+    def emit_line(line: str) -> None:
+        nonlocal output_batch
+        output_batch.append(line)
+        if len(output_batch) >= OUTPUT_BATCH_LINES:
+            write_batch(output_batch)
+            output_batch = []
 
-    Memory complexity: O(1) outside of depth first search stack and current path state.
+    def flush() -> None:
+        nonlocal output_batch
+        if output_batch:
+            write_batch(output_batch)
+            output_batch = []
+
+    return emit_line, flush
+
+def write_batches(batch_queue: "queue.Queue[Optional[List[str]]]", out: TextIO,
+                  write_errors: List[BaseException]) -> None:
+    """
+    Writer thread: write each batch of lines taken from batch_queue until None.
+    After a failure the remaining batches are only drained, so the producer
+    never blocks on a full queue, and the error is left in write_errors.
     """
-    scanner = LazyTreeFileScanner(input_path)
+    while True:
+        batch = batch_queue.get()
+        if batch is None:
+            return
+        if write_errors:
+            continue
+        try:
+            out.write("\n".join(batch) + "\n")
+        except BaseException as error:
+            write_errors.append(error)
 
-    initial_state: StateType = ({}, [])
-    dfs_stack: List[Tuple[int, StateType]] = [(root_node_id, initial_state)]
+# ------------------------------------------------------------------------------
+# Parallel expansion of independent subtrees
+# The parent expands the top of the tree down to a split depth, each node found
+# there is flattened by a worker process into its own temporary file, and the
+# parts are concatenated in DFS order.
 
-    with open(output_path, "w", encoding="utf-8") as out:
-        while dfs_stack:
-            current_node_id, current_state = dfs_stack.pop()
-            node_obj = scanner.get_node_by_id(current_node_id)
+PARALLEL_SPLIT_DEPTH = 2  # extra levels above log2(workers), to balance the tasks
 
-            if node_obj["type"] == "leaf":
-                strategy_text = format_state_as_strategy(current_state)
-                line = f"{strategy_text} : {node_obj['value']}".strip()
-                out.write(line + "\n")
-                continue
+# Parsed tree of a worker process: (nodes, codec).
+# Inherited when the pool forks, otherwise parsed by init_pool_worker.
+WORKER_TREE: Optional[Tuple[TreeNodes, FeatureCodec]] = None
+
+def load_tree(input_path: str) -> Tuple[TreeNodes, FeatureCodec]:
+    """
+    Parse the tree in memory. Feature ids only depend on the file content, so
+    every process loading the same file agrees on them.
+    """
+    codec = FeatureCodec()
+    nodes = parse_tree_file(input_path, codec=codec)
+    return nodes, codec
+
+def init_pool_worker(input_path: str) -> None:
+    global WORKER_TREE
+    if WORKER_TREE is None:
+        WORKER_TREE = load_tree(input_path)
 
-            or_conditions: List[Dict[str, Any]] = node_obj["conds"]
+def flatten_subtree_to_file(node_id: int, state: ConstraintState, temp_dir: str) -> str:
+    """
+    Worker task: write the strategies below node_id, starting from state, to a
+    new file in temp_dir and return its path.
+    """
+    assert WORKER_TREE is not None
+    nodes, codec = WORKER_TREE
+    file_descriptor, part_path = tempfile.mkstemp(suffix=".txt", dir=temp_dir)
+    with open(file_descriptor, "w", encoding="utf-8", buffering=OUTPUT_BUFFER_BYTES) as out:
+
+        def write_batch(batch: List[str]) -> None:
+            out.write("\n".join(batch) + "\n")
 
-            # NO branch: add all negated conditions; skip if contradiction
-            negated_conds = [negate_condition(c) for c in or_conditions]
-            no_branch_state = add_all_conditions_to_state(current_state, negated_conds)
-            if no_branch_state is not None:
-                dfs_stack.append((node_obj["no"], no_branch_state))
+        emit_line, flush = make_line_batcher(write_batch)
+        expand_tree(nodes.__getitem__, codec, state, node_id, emit_line)
+        flush()
+    return part_path
 
-            # YES branch: one branch per cond, each with that cond added
-            for cond in or_conditions:
-                yes_branch_state = add_condition_to_state(current_state, cond)
-                if yes_branch_state is not None:
-                    dfs_stack.append((node_obj["yes"], yes_branch_state))
+def flatten_tree_parallel(input_path: str, output_path: str, root_node_id: int, workers: int) -> None:
+    """
+    flatten_tree_file with the subtrees below PARALLEL_SPLIT_DEPTH + log2(workers)
+    flattened by a pool of worker processes. Same output, same order.
+    """
+    global WORKER_TREE
+    nodes, codec = WORKER_TREE = load_tree(input_path)
+    split_depth = PARALLEL_SPLIT_DEPTH + workers.bit_length()
+
+    try:
+        # Default temporary location: the output may be /dev/stdout or sit
+        # in a read-only directory
+        with tempfile.TemporaryDirectory() as temp_dir, \
+                ProcessPoolExecutor(max_workers=workers, initializer=init_pool_worker,
+                                    initargs=(input_path,)) as executor:
+            # Leaves above the split depth are kept as lines, subtrees as futures
+            segments: List[Any] = []
+
+            def split_subtree(node_id: int, state: ConstraintState) -> None:
+                segments.append(executor.submit(flatten_subtree_to_file, node_id, state, temp_dir))
+
+            expand_tree(nodes.__getitem__, codec, ConstraintState(len(codec.feature_names)),
+                        root_node_id, segments.append, split_depth, split_subtree)
+
+            with open(output_path, "w", encoding="utf-8", buffering=OUTPUT_BUFFER_BYTES) as out:
+                for segment in segments:
+                    if isinstance(segment, str):
+                        out.write(segment + "\n")
+                        continue
+                    part_path = segment.result()
+                    with open(part_path, "r", encoding="utf-8") as part:
+                        shutil.copyfileobj(part, out, OUTPUT_BUFFER_BYTES)
+                    os.remove(part_path)
+    finally:
+        WORKER_TREE = None
 
 # ------------------------------------------------------------------------------
-# CLI entry point
+# Flatten tree into strategies with contradiction pruning
 
-if __name__ == "__main__":
+IN_MEMORY_TREE_MAX_BYTES = 8 * 1024 * 1024  # parsed, about 200 MB per process
+
+def write_strategies(get_node: Callable[[int], Dict[str, Any]], codec: FeatureCodec,
+                     output_path: str, root_node_id: int) -> None:
+    """
+    Expand the tree from root_node_id and write one strategy per line to output_path.
+    """
+    with open(output_path, "w", encoding="utf-8", buffering=OUTPUT_BUFFER_BYTES) as out:
+        # Full batches are handed to a writer thread, the DFS keeps running
+        # while the lines are written (file writes release the GIL).
+        batch_queue: "queue.Queue[Optional[List[str]]]" = queue.Queue(maxsize=OUTPUT_QUEUE_MAX_BATCHES)
+        write_errors: List[BaseException] = []
+        writer = threading.Thread(target=write_batches, args=(batch_queue, out, write_errors), daemon=True)
+        writer.start()
+
+        def put_batch(batch: List[str]) -> None:
+            # Stop the expansion as soon as the writer has failed
+            if write_errors:
+                raise write_errors[0]
+            batch_queue.put(batch)
+
+        emit_line, flush = make_line_batcher(put_batch)
+        try:
+            expand_tree(get_node, codec, ConstraintState(len(codec.feature_names)),
+                        root_node_id, emit_line)
+            flush()
+        finally:
+            batch_queue.put(None)
+            writer.join()
+    if write_errors:
+        raise write_errors[0]
+
+def flatten_tree_file(input_path: str, output_path: str, root_node_id: int = 0,
+                      workers: int = 1) -> None:
+    """
+    Read a binary tree with OR between conditions using '=' and '!=',
+    and generate all AND only strategies, writing them to output_path.
+
+    - YES branch: one branch for each individual OR condition.
+    - NO branch: all OR conditions are negated and combined.
+    - Any contradiction like browser=7 then browser=8 > branch is skipped.
 
-    if len(sys.argv) == 3:
-        flatten_tree_file(sys.argv[1], sys.argv[2], root_node_id=0)
+    Trees up to IN_MEMORY_TREE_MAX_BYTES are parsed once into a dict, larger
+    files fall back to LazyTreeFileScanner to bound the memory used by the tree.
+    workers > 1 (process pool, see flatten_tree_parallel) needs the whole tree
+    and is only used in the first case.
+    """
+    in_memory = os.path.getsize(input_path) <= IN_MEMORY_TREE_MAX_BYTES
+    if in_memory and workers > 1:
+        flatten_tree_parallel(input_path, output_path, root_node_id, workers)
+        return
+
+    if in_memory:
+        nodes, codec = load_tree(input_path)
+        write_strategies(nodes.__getitem__, codec, output_path, root_node_id)
     else:
-        print("Please use the command below: python script.py <tree_to_convert.txt> <strategies.txt>")
+        codec = FeatureCodec()
+        with LazyTreeFileScanner(input_path, codec=codec) as scanner:
+            write_strategies(scanner.get_node_by_id, codec, output_path, root_node_id)
+
+# ------------------------------------------------------------------------------
+# CLI entry point
 
+if __name__ == "__main__":
 
+    if len(sys.argv) in (3, 4):
+        flatten_tree_file(sys.argv[1], sys.argv[2], root_node_id=0,
+                          workers=int(sys.argv[3]) if len(sys.argv) == 4 else 1)
+    else:
+        print("Please use the command below: python script.py <tree_to_convert.txt> <strategies.txt> [workers]")